@@ -1,6 +1,8 @@
 from .seedr_handler import SeedrHandler
+from .download_scheduler import DownloadScheduler
+from .job_journal import JobJournal
 
 
 name = "SeedrClient"
 __version__ = "0.1.7"
-__all__ = ["__version__", "SeedrHandler"]
+__all__ = ["__version__", "SeedrHandler", "DownloadScheduler", "JobJournal"]
@@ -0,0 +1,394 @@
+import re
+import aria2p
+import itertools
+import requests
+import threading
+from time import sleep
+
+
+class DownloadJob:
+    """
+    The files of a single download_folder call as tracked by the DownloadScheduler. Files wait in pending until the job
+    is given a slot, are then tracked by their gid in active while aria2 downloads them, and end up in either completed
+    or failed.
+    """
+
+    def __init__(
+        self,
+        job_id,
+        aria2,
+        items,
+        priority=0,
+        max_concurrent=None,
+        max_download_limit=0,
+        on_start=None,
+        on_complete=None,
+    ):
+        self.job_id = job_id
+        self.aria2 = aria2
+        # Files that already carry a gid were handed to aria2 by an earlier run, so they are tracked right away
+        self.pending = [item for item in items if not item.get("gid")]
+        self.priority = priority
+        self.max_concurrent = max_concurrent
+        self.max_download_limit = max_download_limit
+        self.on_start = on_start
+        self.on_complete = on_complete
+        # The per file bandwidth cap last applied to the active downloads, None until one has been applied
+        self.download_limit_applied = None
+        self.active = {item["gid"]: item for item in items if item.get("gid")}
+        self.completed = []
+        self.failed = []
+        # Used to round-robin between jobs of the same priority
+        self.last_served = 0
+
+    @property
+    def is_done(self):
+        return not self.pending and not self.active
+
+
+class DownloadScheduler:
+    """
+    A download scheduler that is shared by every download_folder call made in the process. Rather than adding every
+    file to aria2 at once, files are held back and only handed to aria2 when a slot frees up, which allows job
+    priorities, concurrency caps and bandwidth caps to be enforced across all the folders being downloaded.
+
+    Jobs with a higher priority are always served first, jobs with the same priority take turns so that no single
+    folder hogs every slot.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+    season_episode_regex = re.compile(
+        r"(?:s(?P<season>\d{1,2})[ ._-]*e|\b(?P<short_season>\d{1,2})x)(?P<episode>\d{1,3})(?!\d)",
+        re.IGNORECASE,
+    )
+    # Only matched after a space, dot, underscore or bracket, so that release tags like "x265-E1" aren't matched
+    episode_regex = re.compile(
+        r"(?:^|(?<=[ ._\[(]))(?:episode|ep|e)[ ._-]*(?P<episode>\d{1,3})(?!\d)",
+        re.IGNORECASE,
+    )
+    size_regex = re.compile(r"(?P<value>[\d.]+)\s*(?P<unit>[KMGT]?B)", re.IGNORECASE)
+    size_units = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+    # Errors raised by a job's aria2, either by aria2 itself or because it couldn't be reached. They only ever fail
+    # the job whose aria2 raised them, as every job is polled from whichever thread happens to be waiting
+    aria2_errors = (aria2p.ClientException, requests.exceptions.RequestException)
+
+    def __init__(
+        self,
+        max_concurrent=5,
+        max_concurrent_per_job=None,
+        max_overall_download_limit=0,
+        poll_interval=5,
+    ):
+        """
+        :param max_concurrent: The maximum number of files downloading at the same time across all jobs
+        :type max_concurrent: int
+        :param max_concurrent_per_job: The default maximum number of files a single job can download at the same time,
+            None means a job can use every free slot
+        :type max_concurrent_per_job: int
+        :param max_overall_download_limit: The global bandwidth cap in bytes per second, 0 means unlimited
+        :type max_overall_download_limit: int
+        :param poll_interval: The number of seconds to wait between checks on the state of the downloads
+        :type poll_interval: int
+        """
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_per_job = max_concurrent_per_job
+        self.max_overall_download_limit = max_overall_download_limit
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.lock = threading.RLock()
+        self._job_ids = itertools.count(1)
+        self._turns = itertools.count(1)
+        # The global bandwidth cap last applied to each aria2, keyed by id
+        self._configured_clients = {}
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the scheduler shared by the whole process, creating it on first use
+
+        :return: The process wide download scheduler
+        :rtype: DownloadScheduler
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, **options):
+        """
+        Configures the scheduler shared by the whole process, creating it with the given options if it doesn't exist
+        yet, e.g. DownloadScheduler.configure(max_concurrent=3, max_overall_download_limit=5 * 1024**2)
+
+        :param options: Any of the arguments accepted by DownloadScheduler
+        :type options: dict
+        :return: The process wide download scheduler
+        :rtype: DownloadScheduler
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**options)
+                return cls._shared
+        scheduler = cls._shared
+        with scheduler.lock:
+            for name, value in options.items():
+                if name not in (
+                    "max_concurrent",
+                    "max_concurrent_per_job",
+                    "max_overall_download_limit",
+                    "poll_interval",
+                ):
+                    raise TypeError(f"configure() got an unexpected keyword argument '{name}'")
+                setattr(scheduler, name, value)
+            # A new global bandwidth cap is applied to each aria2 the next time one of its jobs is submitted
+            scheduler.schedule()
+        return scheduler
+
+    @classmethod
+    def size_to_bytes(cls, size):
+        """
+        The inverse of SeedrHandler.bytes_to_mb_gb, converts a size string like "1.1 GB" back to an approximate
+        number of Bytes so that files can be compared by their actual size
+
+        :param size: The size string to be converted
+        :type size: str
+        :return: The approximate value in Bytes, 0 if the string couldn't be parsed
+        :rtype: int
+        """
+        match = cls.size_regex.search(str(size))
+        if not match:
+            return 0
+        return int(float(match["value"]) * cls.size_units[match["unit"].upper()])
+
+    @classmethod
+    def episode_number(cls, file_name):
+        """
+        Tries to find the season and episode number in a file name, e.g. "Show.S01E02.mkv" or "Show - Episode 2.mkv"
+
+        :param file_name: The name of the file
+        :type file_name: str
+        :return: A tuple of season and episode number, the season is None if the file name only has an episode
+            number. Returns None if the file name doesn't look like an episode.
+        :rtype: Union[tuple, None]
+        """
+        match = cls.season_episode_regex.search(file_name)
+        if match:
+            return int(match["season"] or match["short_season"]), int(match["episode"])
+        match = cls.episode_regex.search(file_name)
+        if match:
+            return None, int(match["episode"])
+        return None
+
+    def order_items(self, items, first_episode_first=True):
+        """
+        Orders the files of a job smallest first, and if first_episode_first is set, moves the first episode of a
+        series to the front of the queue so that it can be started ahead of the rest. Files with only an episode number
+        are ignored if any file of the job has a season as well, as those are usually extras.
+
+        :param items: The files of the job as returned by download_folder
+        :type items: list
+        :param first_episode_first: Whether the first episode should be moved to the front of the queue
+        :type first_episode_first: bool
+        :return: The ordered list of files
+        :rtype: list
+        """
+        ordered = sorted(items, key=lambda d: self.size_to_bytes(d["size"]))
+        if first_episode_first:
+            episodes = [
+                (self.episode_number(item["file_name"]), i)
+                for i, item in enumerate(ordered)
+            ]
+            episodes = [episode for episode in episodes if episode[0] is not None]
+            with_season = [episode for episode in episodes if episode[0][0] is not None]
+            if with_season:
+                episodes = with_season
+            if episodes:
+                ordered.insert(0, ordered.pop(min(episodes)[1]))
+        return ordered
+
+    def submit(
+        self,
+        aria2,
+        items,
+        priority=0,
+        max_concurrent=None,
+        max_download_limit=0,
+        first_episode_first=True,
+        on_start=None,
+        on_complete=None,
+    ):
+        """
+        Adds a new job to the scheduler, the files are only handed to aria2 once the job is allowed a slot
+
+        :param aria2: The aria2p API that the files of this job should be added to
+        :type aria2: aria2p.API
+        :param items: A list of files with their download url and folder path, as built by download_folder
+        :type items: list
+        :param priority: The priority of the job, jobs with a higher value are served first
+        :type priority: int
+        :param max_concurrent: The maximum number of files of this job downloading at the same time, defaults to the
+            scheduler's max_concurrent_per_job
+        :type max_concurrent: int
+        :param max_download_limit: The bandwidth cap for this job in bytes per second, split between the files it has
+            downloading at the time, 0 means unlimited
+        :type max_download_limit: int
+        :param first_episode_first: Whether the first episode of a series should be started ahead of the rest
+        :type first_episode_first: bool
+        :param on_start: A function that is called with the file and its gid every time a file is handed to aria2, files
+            that already have a "gid" key are assumed to be in aria2 and are not added again
+        :type on_start: Callable
+        :param on_complete: A function that is called with the file and its gid once aria2 has finished downloading it
+        :type on_complete: Callable
+        :return: The id of the job
+        :rtype: int
+        """
+        with self.lock:
+            job_id = next(self._job_ids)
+            self.jobs[job_id] = DownloadJob(
+                job_id=job_id,
+                aria2=aria2,
+                items=self.order_items(items, first_episode_first=first_episode_first),
+                priority=priority,
+                max_concurrent=max_concurrent or self.max_concurrent_per_job,
+                max_download_limit=max_download_limit,
+                on_start=on_start,
+                on_complete=on_complete,
+            )
+            self._configure_client(aria2)
+            self.schedule()
+            return job_id
+
+    def _configure_client(self, aria2):
+        if self._configured_clients.get(id(aria2), 0) != self.max_overall_download_limit:
+            aria2.set_global_options(
+                {"max-overall-download-limit": str(self.max_overall_download_limit)}
+            )
+            self._configured_clients[id(aria2)] = self.max_overall_download_limit
+
+    def _job_slots(self, job):
+        if job.max_concurrent:
+            return job.max_concurrent
+        return self.max_concurrent
+
+    def _start(self, job):
+        item = job.pending.pop(0)
+        options = {"dir": item["folder_path"]}
+        if job.max_download_limit:
+            # Starts with its share of the job's bandwidth, rebalance updates the others once it is added
+            options["max-download-limit"] = str(
+                max(job.max_download_limit // (len(job.active) + 1), 1)
+            )
+        job.last_served = next(self._turns)
+        try:
+            download_adder = job.aria2.add(uri=item["download_url"], options=options)
+        except self.aria2_errors:
+            # A file aria2 refuses must not stop the other jobs from being scheduled
+            job.failed.append(item)
+            return
+        job.active[download_adder[0].gid] = item
+        if job.on_start:
+            job.on_start(item, download_adder[0].gid)
+
+    def rebalance(self, job):
+        """
+        Splits the bandwidth cap of the job evenly between the files it has downloading right now, and updates the
+        limit of each of those downloads in aria2 whenever their number changes
+
+        :param job: The job whose bandwidth should be split
+        :type job: DownloadJob
+        """
+        if not job.max_download_limit or not job.active:
+            return
+        download_limit = max(job.max_download_limit // len(job.active), 1)
+        if download_limit == job.download_limit_applied:
+            return
+        for gid in job.active:
+            try:
+                job.aria2.client.change_option(
+                    gid, {"max-download-limit": str(download_limit)}
+                )
+            except self.aria2_errors:
+                # The download finished since the last poll or aria2 can't be reached, either way the next poll
+                # deals with it
+                pass
+        job.download_limit_applied = download_limit
+
+    def schedule(self):
+        """
+        Hands files to aria2 until all slots are in use, the highest priority job with a free slot is served first and
+        ties between jobs of the same priority go to the job that was served least recently
+        """
+        with self.lock:
+            while sum(len(job.active) for job in self.jobs.values()) < self.max_concurrent:
+                candidates = [
+                    job
+                    for job in self.jobs.values()
+                    if job.pending and len(job.active) < self._job_slots(job)
+                ]
+                if not candidates:
+                    break
+                self._start(
+                    min(candidates, key=lambda job: (-job.priority, job.last_served))
+                )
+            for job in self.jobs.values():
+                self.rebalance(job)
+
+    def poll(self):
+        """
+        Checks every active download and frees the slots of those that have completed, failed or were removed, then
+        fills the freed slots. Downloads that failed or were removed are kept apart from the completed ones.
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                for gid, item in list(job.active.items()):
+                    try:
+                        download_info = job.aria2.get_download(gid=gid)
+                    except aria2p.ClientException:
+                        # aria2 no longer knows the gid, it was removed or purged
+                        job.failed.append(item)
+                        del job.active[gid]
+                        continue
+                    except requests.exceptions.RequestException:
+                        # The job's aria2 can't be reached, so only this job's downloads are given up on
+                        job.failed += job.active.values()
+                        job.active = {}
+                        break
+                    if download_info.is_complete:
+                        job.completed.append(item)
+                        del job.active[gid]
+                        if job.on_complete:
+                            job.on_complete(item, gid)
+                    elif download_info.has_failed or download_info.is_removed:
+                        job.failed.append(item)
+                        del job.active[gid]
+            self.schedule()
+
+    def wait(self, job_id):
+        """
+        Blocks until every file of the job has finished downloading, other jobs keep being scheduled meanwhile
+
+        :param job_id: The id of the job as returned by submit
+        :type job_id: int
+        :return: The files of the job that failed to download or were removed, an empty list if every file completed
+        :rtype: list
+        """
+        while True:
+            self.poll()
+            with self.lock:
+                job = self.jobs[job_id]
+                if job.is_done:
+                    self.cancel(job_id)
+                    return job.failed
+            sleep(self.poll_interval)
+
+    def cancel(self, job_id):
+        """
+        Removes the job from the scheduler so none of its pending files are handed to aria2, files that were already
+        handed over are left in aria2. Cancelling a job that was already removed does nothing.
+
+        :param job_id: The id of the job as returned by submit
+        :type job_id: int
+        """
+        with self.lock:
+            self.jobs.pop(job_id, None)
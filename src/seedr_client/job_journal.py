@@ -0,0 +1,153 @@
+import os
+import json
+import sqlite3
+import threading
+from time import time
+
+
+class JobJournal:
+    """
+    An append-only journal of the steps taken by long-running operations such as download_folder, delete_all and
+    add_torrents. Every step is committed to an SQLite database in WAL mode as soon as it is done, so that if the
+    process dies partway through, the next call of the same operation picks up the recorded steps and only does the
+    unfinished work.
+
+    Each call of an operation is a run, identified by the operation name and a key (e.g. the folder id). A run stays
+    open until it is finished, and calling the same operation with the same key while a run is open resumes that run.
+    Runs older than max_age are not resumed, as the folder listings and download urls they hold may no longer be valid.
+    """
+
+    def __init__(self, path, max_age=6 * 60 * 60):
+        """
+        :param path: The path of the SQLite database file, the directory is created if it doesn't exist. Pass
+            ":memory:" to keep the journal in memory instead, in which case nothing survives the process dying.
+        :type path: str
+        :param max_age: The number of seconds after it started that an unfinished run can still be resumed
+        :type max_age: int
+        """
+        self.path = path
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # The scheduler may record steps from whichever thread happens to be polling aria2
+        self.connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "operation TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "started REAL NOT NULL, "
+                "finished REAL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps ("
+                "step_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "run_id INTEGER NOT NULL REFERENCES runs(run_id), "
+                "step TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "value TEXT, "
+                "recorded REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS steps_run_step ON steps (run_id, step)"
+            )
+
+    def begin(self, operation, key=""):
+        """
+        Resumes the unfinished run of the operation with the same key if there is one that isn't older than max_age,
+        else starts a new run
+
+        :param operation: The name of the operation, e.g. "download_folder"
+        :type operation: str
+        :param key: What sets this run apart from other runs of the same operation, e.g. the folder id
+        :type key: Union[str, int]
+        :return: The id of the run
+        :rtype: int
+        """
+        with self.lock:
+            # Unfinished runs that are too old to be resumed are closed, so that they are never picked up again
+            self.connection.execute(
+                "UPDATE runs SET finished = ? WHERE operation = ? AND key = ? AND finished IS NULL AND started < ?",
+                (time(), operation, str(key), time() - self.max_age),
+            )
+            row = self.connection.execute(
+                "SELECT run_id FROM runs WHERE operation = ? AND key = ? AND finished IS NULL "
+                "ORDER BY run_id DESC LIMIT 1",
+                (operation, str(key)),
+            ).fetchone()
+            if row:
+                return row[0]
+            cursor = self.connection.execute(
+                "INSERT INTO runs (operation, key, started) VALUES (?, ?, ?)",
+                (operation, str(key), time()),
+            )
+            return cursor.lastrowid
+
+    def record(self, run_id, step, key, value=None):
+        """
+        Appends a step to the run, a later step with the same name and key takes precedence over an earlier one
+
+        :param run_id: The id of the run as returned by begin
+        :type run_id: int
+        :param step: The name of the step, e.g. "folder_listed"
+        :type step: str
+        :param key: What the step was done on, e.g. the folder id
+        :type key: Union[str, int]
+        :param value: The result of the step, it must be json serializable
+        :type value: Any
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO steps (run_id, step, key, value, recorded) VALUES (?, ?, ?, ?, ?)",
+                (run_id, step, str(key), json.dumps(value), time()),
+            )
+
+    def steps(self, run_id, step):
+        """
+        Returns every step of the given name that was recorded for the run
+
+        :param run_id: The id of the run as returned by begin
+        :type run_id: int
+        :param step: The name of the step, e.g. "folder_listed"
+        :type step: str
+        :return: A dictionary mapping the key of each step to its value
+        :rtype: dict
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, value FROM steps WHERE run_id = ? AND step = ? ORDER BY step_id",
+                (run_id, step),
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def finish(self, run_id):
+        """
+        Marks the run as finished, so the next call of the same operation starts over
+
+        :param run_id: The id of the run as returned by begin
+        :type run_id: int
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE runs SET finished = ? WHERE run_id = ?", (time(), run_id)
+            )
+
+    def close(self):
+        """
+        Closes the connection to the database, the journal can't be used afterwards. Unfinished runs stay in the
+        database file and are resumed by the next journal opened on it.
+        """
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -8,6 +8,8 @@ import subprocess
 from time import sleep
 from random import randrange
 from torrentool.api import Torrent
+from .download_scheduler import DownloadScheduler
+from .job_journal import JobJournal
 from .errors import (
     InvalidLogin,
     InvalidToken,
@@ -26,6 +28,8 @@ class SeedrHandler:
         access_token=None,
         aria2c_secret=None,
         download_directory=".",
+        download_scheduler=None,
+        journal_path=None,
     ):
         self.rate_limit = 1
         self.email = email
@@ -48,6 +52,27 @@ class SeedrHandler:
         self.aria2c_secret = aria2c_secret
         self.seedr_download_options = {"user_agent": "Mozilla/5.0"}
         self.download_directory = download_directory
+        # Every SeedrHandler in the process shares the same scheduler unless one is passed explicitly
+        self.download_scheduler = download_scheduler or DownloadScheduler.shared()
+        # Progress of download_folder, delete_all and add_torrents is journaled here so that they can resume after a
+        # crash. It is kept next to the downloads unless a journal_path is passed, ":memory:" turns off resuming
+        self.journal = JobJournal(
+            journal_path
+            or os.path.join(self.download_directory, ".seedr_client_journal.sqlite3")
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the journal of the client, call this once you are done with the client or use the client as a context
+        manager instead
+        """
+        self.journal.close()
 
     @staticmethod
     def contains_bad_token(response_text):
@@ -373,7 +398,45 @@ class SeedrHandler:
                 f"The provided Torrent couldn't be leeched/downloaded to the drive.\n {data=}"
             )
 
-    def download_folder(self, folder_id, builtin_downloader=True):
+    def add_torrents(self, torrents, folder_id=-1, check_size=True):
+        """
+        Adds a batch of torrent files or magnet uris to Seedr, one after the other. Each torrent is recorded in the
+        journal against the folder once Seedr accepts it, so if a batch is interrupted, the next call for the same
+        folder skips the torrents that were already added, even if the batch passed this time is a different one.
+
+        :param torrents: The torrent files or magnet uris that you want to add to be leeched/downloaded
+        :type torrents: list
+        :param folder_id: The folder you want the torrents to be downloaded to. Defaults to parent.
+        :type folder_id: int
+        :param check_size: Used to inform function if checking of Seedr drive space with torrent size is
+            required or not, see add_torrent.
+        :type check_size: bool
+        :return: A list with the result of add_torrent for each of the torrents, in the same order
+        :rtype: list
+        """
+        # The run is keyed by the folder alone and stays open until a batch completes, so a retry with a different
+        # batch still sees every torrent added by the interrupted one
+        run_id = self.journal.begin("add_torrents", folder_id)
+        added = self.journal.steps(run_id, "torrent_added")
+        for torrent in torrents:
+            if torrent not in added:
+                added[torrent] = self.add_torrent(
+                    torrent=torrent, folder_id=folder_id, check_size=check_size
+                )
+                self.journal.record(run_id, "torrent_added", torrent, added[torrent])
+                sleep(self.rate_limit)
+        self.journal.finish(run_id)
+        return [added[torrent] for torrent in torrents]
+
+    def download_folder(
+        self,
+        folder_id,
+        builtin_downloader=True,
+        priority=0,
+        max_concurrent=None,
+        max_download_limit=0,
+        first_episode_first=True,
+    ):
         """
         This function either downloads the entire folder excluding any extensions that are bared or returns a list of
         files with their exact order and download url.
@@ -384,21 +447,50 @@ class SeedrHandler:
             all by itself or wish to just get a dictionary of files and their information so that you can download them
             yourself.
         :type builtin_downloader: bool
+        :param priority: The priority of this download among all the folders being downloaded by the process, folders
+            with a higher value are downloaded first
+        :type priority: int
+        :param max_concurrent: The maximum number of files of this folder downloading at the same time, defaults to the
+            download scheduler's per job limit
+        :type max_concurrent: int
+        :param max_download_limit: The bandwidth cap for this folder in bytes per second, shared between the files of
+            the folder that are downloading at the time, 0 means unlimited
+        :type max_download_limit: int
+        :param first_episode_first: If the folder contains a series, the first episode is started ahead of the rest
+        :type first_episode_first: bool
         :return: Returns a dict if builtin_downloader is set to False or returns True after completing the download of
-            the folder.
+            the folder. Returns False if any of the files failed to download, calling this method again for the same
+            folder retries only those files.
         :rtype: Union[dict, bool]
         """
-        content = self.get_folder(folder_id=folder_id)
-        sleep(self.rate_limit)
-        download_list = content["files"]
-        next_list_folders = content["folders"]
+        # Every folder listed, url resolved, file queued and file completed is journaled, so an interrupted download of the same folder
+        # resumes from where it stopped
+        run_id = self.journal.begin("download_folder", folder_id)
+        listed = self.journal.steps(run_id, "folder_listed")
+        resolved = self.journal.steps(run_id, "url_resolved")
+        queued = self.journal.steps(run_id, "gid_queued")
+        completed = self.journal.steps(run_id, "file_completed")
+        download_list = []
+        next_list_folders = [folder_id]
         while True:
             if next_list_folders:
                 temp_list_folders = []
-                for folder in next_list_folders:
-                    subfolder_content = self.get_folder(folder_id=folder["folder_id"])
-                    sleep(self.rate_limit)
-                    temp_list_folders += subfolder_content["folders"]
+                for current_folder_id in next_list_folders:
+                    if str(current_folder_id) not in listed:
+                        listed[str(current_folder_id)] = self.get_folder(
+                            folder_id=current_folder_id
+                        )
+                        self.journal.record(
+                            run_id,
+                            "folder_listed",
+                            current_folder_id,
+                            listed[str(current_folder_id)],
+                        )
+                        sleep(self.rate_limit)
+                    subfolder_content = listed[str(current_folder_id)]
+                    temp_list_folders += [
+                        folder["folder_id"] for folder in subfolder_content["folders"]
+                    ]
                     download_list += subfolder_content["files"]
                 next_list_folders = temp_list_folders
             else:
@@ -414,14 +506,26 @@ class SeedrHandler:
                 )
                 temp_download_list.append(item)
         download_list = temp_download_list
-        for i in range(len(download_list)):
-            download_list[i]["download_url"] = self.get_file(
-                download_list[i]["folder_file_id"]
-            )["download_url"]
-            sleep(self.rate_limit)
+        if builtin_downloader:
+            # Files an interrupted run already finished downloading are on disk, so they are neither resolved nor
+            # handed to aria2 again
+            download_list = [
+                item
+                for item in download_list
+                if str(item["folder_file_id"]) not in completed
+            ]
+        for item in download_list:
+            file_key = str(item["folder_file_id"])
+            if not resolved.get(file_key):
+                resolved[file_key] = self.get_file(item["folder_file_id"])[
+                    "download_url"
+                ]
+                self.journal.record(run_id, "url_resolved", file_key, resolved[file_key])
+                sleep(self.rate_limit)
+            item["download_url"] = resolved[file_key]
         if not builtin_downloader:
+            self.journal.finish(run_id)
             return download_list
-        download_list = sorted(download_list, key=lambda d: d["size"])
         # Only runs if aria2p client hasn't already been initiated
         if not self.aria2:
             self.aria2 = aria2p.API(
@@ -429,30 +533,58 @@ class SeedrHandler:
                     host="http://localhost", port=6800, secret=self.aria2c_secret
                 )
             )
-        download_queue = []
-        # Adds each url obtained from previous steps one by one with priorities given for smallest files first
-        for i in range(len(download_list)):
-            download_adder = self.aria2.add(
-                uri=download_list[i]["download_url"],
-                # TODO make the directory data dynamic, such that each file is downloaded to the appropriate folder
-                options={"dir": download_list[i]["folder_path"]},
-                position=i,
-            )
-            download_queue.append(download_adder[0].gid)
-        while True:
-            # TODO FUTURE show progress real time
-            temp_download_queue = []
-            for gid in download_queue:
-                download_info = self.aria2.get_download(gid=gid)
-                if not download_info.is_complete:
-                    temp_download_queue.append(gid)
-            download_queue = temp_download_queue
-            if len(download_queue) == 0:
-                break
-            sleep(5)
+        # Files queued by an interrupted run are only added to aria2 again if aria2 no longer has them
+        for item in download_list:
+            gid = queued.get(str(item["folder_file_id"]))
+            if gid and self.is_download_alive(gid=gid):
+                item["gid"] = gid
+        # The scheduler hands the files to aria2 smallest first, sharing the download slots with any other folders
+        # being downloaded by the process
+        # TODO FUTURE show progress real time
+        job_id = self.download_scheduler.submit(
+            aria2=self.aria2,
+            items=download_list,
+            priority=priority,
+            max_concurrent=max_concurrent,
+            max_download_limit=max_download_limit,
+            first_episode_first=first_episode_first,
+            on_start=lambda item, gid: self.journal.record(
+                run_id, "gid_queued", item["folder_file_id"], gid
+            ),
+            on_complete=lambda item, gid: self.journal.record(
+                run_id, "file_completed", item["folder_file_id"], gid
+            ),
+        )
+        try:
+            failed = self.download_scheduler.wait(job_id)
+        finally:
+            # Makes sure an interrupted wait doesn't leave the job's pending files behind in the shared scheduler
+            self.download_scheduler.cancel(job_id)
+        if failed:
+            # The journal run is left open so that the next call only retries the failed files, and their urls are
+            # cleared in case they failed because the url expired
+            for item in failed:
+                self.journal.record(run_id, "url_resolved", item["folder_file_id"])
+            return False
+        self.journal.finish(run_id)
         # TODO return parent directory instead
         return True
 
+    def is_download_alive(self, gid):
+        """
+        Checks if aria2 still has the download associated with the gid and that it hasn't failed or been removed
+
+        :param gid: The gid of the download in aria2
+        :type gid: str
+        :return: Returns True if the download is queued, running or complete, False otherwise
+        :rtype: bool
+        """
+        try:
+            download_info = self.aria2.get_download(gid=gid)
+        except aria2p.ClientException:
+            return False
+        return not (download_info.has_failed or download_info.is_removed)
+
     def delete_folder(self, folder_id):
         """
         This method deletes the folder associated with the id that is passed and returns True on success
@@ -525,16 +657,30 @@ class SeedrHandler:
         :return: Returns True if the method clears the whole drive successfully, False otherwise.
         :rtype: bool
         """
+        # The drive is listed on every call, so it already holds exactly what is left to delete after an interruption.
+        # Deleted items are only journaled as a record of what was deleted
+        run_id = self.journal.begin("delete_all")
         content = self.get_drive()
-        for folder in content["folders"]:
-            self.delete_folder(folder["folder_id"])
-            sleep(self.rate_limit)
-        for file in content["files"]:
-            self.delete_file(file["folder_file_id"])
-            sleep(self.rate_limit)
-        for torrent in content["torrents"]:
-            self.delete_torrent(torrent["torrent_id"])
+        to_delete = (
+            [("folder", folder["folder_id"]) for folder in content["folders"]]
+            + [("file", file["folder_file_id"]) for file in content["files"]]
+            + [("torrent", torrent["torrent_id"]) for torrent in content["torrents"]]
+        )
+        delete_methods = {
+            "folder": self.delete_folder,
+            "file": self.delete_file,
+            "torrent": self.delete_torrent,
+        }
+        for item_type, item_id in to_delete:
+            try:
+                is_deleted = delete_methods[item_type](item_id)
+            except FileNotFoundError:
+                # The item was already deleted, e.g. by an interrupted run
+                is_deleted = True
+            if is_deleted:
+                self.journal.record(run_id, "item_deleted", f"{item_type}:{item_id}")
             sleep(self.rate_limit)
+        self.journal.finish(run_id)
         content = self.get_drive()
         if content["space"]["used"] == "0.0 GB":
             return True